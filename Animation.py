@@ -1,6 +1,6 @@
 ''' Animate the evolution of galaxy'''
 
-from common import *
+from common import read_evolution, create_video
 import time
 from numpy import loadtxt
 
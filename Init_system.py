@@ -1,5 +1,5 @@
 ''' Create a galaxy of N bodies using diferent models'''
-from common import *
+from common import system_init_write, read_model
 from numpy import loadtxt
 
 
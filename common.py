@@ -1,13 +1,23 @@
 # 3D Barnes-Hut Algorithm for evolution of a galaxy 
 
-from numpy import array, empty, random, float, sqrt, exp, pi, sin, cos, tan, arctan, zeros, save, load, cross, dot
+import numpy as np
 from mpl_toolkits.mplot3d import Axes3D
-import scipy.integrate as integrate
-from scipy.optimize import fsolve
 import matplotlib.pyplot as plt
-from numpy.linalg import norm
-from copy import deepcopy
+from dataclasses import dataclass
+import math
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
+try:
+    import numba
+    from numba import njit, prange
+    NUMBA = True
+except ImportError:
+    # Without Numba the forces are computed with the pure-Python
+    # octo-tree made of Node objects.
+    NUMBA = False
+    prange = range
+    def njit(*args, **kwargs):
+        return lambda f: f
 
 ##### Simulation Parameters ###############################
 
@@ -20,25 +30,45 @@ dt = 1.e-2 #Gyr
 # Theta-criterion of Barnes-Hut algorithm.
 theta = 0.3
 
+# Short distance cutoff of the gravitational force.
+cutoff_dist = 1.e-4
+
 ###########################################################
 
+@dataclass
+class Bodies:
+    '''------------------------------------------------------------------------
+    Structure-of-Arrays container for the N bodies of the system. Every
+    per-body quantity is stored in a contiguous NumPy array, so the time
+    integration is done with vectorized operations over all the bodies.
+    ------------------------------------------------------------------------'''
+    m: np.ndarray      # Masses                 [N]
+    pos: np.ndarray    # Positions              [N,3]
+    mom: np.ndarray    # Momenta                [N,3]
+    m_pos: np.ndarray  # Mass-weighted position [N,3]
+
+    def __len__(self):
+        return len(self.m)
+
 class Node:
     '''------------------------------------------------------------------------
     A node object will represent a body (if node.child is None) or an abstract
     node of the octant-tree if it has node.child attributes.
     ------------------------------------------------------------------------'''
-    def __init__(self, m, position, momentum):
+    def __init__(self, m, position, index=None):
         '''----------------------------------------------------------
         Creates a child-less node using the arguments
         -------------------------------------------------------------
         .mass     : scalar m
         .position : NumPy array  with the coordinates [x,y,z]
-        .momentum : NumPy array  with the components [px,py,pz]
+        .index    : index i of the body in the Bodies arrays
+                    (None for the internal nodes of the tree)
         ----------------------------------------------------------'''
         self.m = m
         self.m_pos = m * position
-        self.momentum = momentum
+        self.index = index
         self.child = None
+        self.is_leaf = True
 
     def position(self):
         '''----------------------------------------------------------
@@ -79,39 +109,60 @@ class Node:
             self.relative_position[i] -= 1.0
         return octant    
 
-def add(body, node):
+def add(body, root):
     '''--------------------------------------------------------------
     Defines the octo-tree by introducing a body and locating it 
     according to three conditions (see documentation for details).
-    Returns the updated node containing the body.
+    The tree is descended iteratively from root. Returns the root of
+    the updated tree containing the body.
     --------------------------------------------------------------'''
     smallest_octant = 1.e-4 # Lower limit for the side-size of the octants
     
-    # Case 1. If node does not contain a body, the body is put in here
-    new_node = body if node is None else None
-    
-    if node is not None and node.size > smallest_octant:
+    # Case 1. If the tree does not contain a body, the body is put in here
+    if root is None:
+        return body
+
+    node = root
+    while True:
         # Case 3. If node is an external node, then the new body can not
         # be put in there. We have to verify if it has .child attribute
         if node.child is None:
-            new_node = deepcopy(node)
-            # Subdivide the node creating 4 children
-            new_node.child = [None for i in range(8)]
+            if node.size <= smallest_octant:
+                # The octant can not be subdivided anymore, so the body
+                # is merged into the external node
+                node.m += body.m
+                node.m_pos += body.m_pos
+                break
+            # Move the body of node to a new leaf and turn node into an
+            # internal node in place
+            leaf = Node.__new__(Node)
+            leaf.m = node.m
+            leaf.m_pos = node.m_pos
+            leaf.index = node.index
+            leaf.size = node.size
+            leaf.relative_position = node.relative_position
+            leaf.child = None
+            leaf.is_leaf = True
+            node.m_pos = node.m_pos.copy()
+            node.index = None
+            node.is_leaf = False
+            # Subdivide the node creating 8 children
+            node.child = [None for i in range(8)]
             # Place the body in the appropiate octant
-            octant = node.place_into_octant()
-            new_node.child[octant] = node
-        # Case 2. If node is an internal node, it already has .child attribute
-        else:
-            new_node = node
-
-        # For cases 2 and 3, it is needed to update the mass and the position
-        # of the node
-        new_node.m += body.m
-        new_node.m_pos += body.m_pos
+            octant = leaf.place_into_octant()
+            node.child[octant] = leaf
+
+        # Case 2. node is an internal node, so it is needed to update its
+        # mass and position before descending
+        node.m += body.m
+        node.m_pos += body.m_pos
         # Add the new body into the appropriate octant.
         octant = body.place_into_octant()
-        new_node.child[octant] = add(body, new_node.child[octant])
-    return new_node
+        if node.child[octant] is None:
+            node.child[octant] = body
+            break
+        node = node.child[octant]
+    return root
 
 def gravitational_force(node1, node2):
     '''--------------------------------------------------------------
@@ -119,15 +170,17 @@ def gravitational_force(node1, node2):
     A short distance cutoff is introduced in order to avoid numerical
     divergences in the gravitational force.
     --------------------------------------------------------------'''
-    cutoff_dist = 1.e-4
-    d12 =  node1.position() - node2.position()
-    d = norm(d12)
-    if d < cutoff_dist:
+    dx = node1.pos_cache[0] - node2.pos_cache[0]
+    dy = node1.pos_cache[1] - node2.pos_cache[1]
+    dz = node1.pos_cache[2] - node2.pos_cache[2]
+    d2 = dx*dx + dy*dy + dz*dz
+    if d2 < cutoff_dist*cutoff_dist:
         # Returns no Force to prevent divergences!
-        return array([0., 0., 0.])
+        return np.array([0., 0., 0.])
     else:
         # Gravitational force
-        return G*node1.m*node2.m*(d12)/d**3
+        f = G*node1.m*node2.m/(d2*math.sqrt(d2))
+        return np.array([f*dx, f*dy, f*dz])
 
 def force_on(body, node, theta):
     '''--------------------------------------------------------------
@@ -138,51 +191,263 @@ def force_on(body, node, theta):
     --------------------------------------------------------------'''
     # 1. If the current node is an external node,
     #    calculate the force exerted by the current node on b.
-    if node.child is None or node.child == [None for ii in range(8)]:
+    if node.is_leaf:
+        # A body does not exert force on itself
+        if node.index == body.index:
+            return np.zeros(3)
         return gravitational_force(node,body)
 
     # 2. Otherwise, calculate the ratio s/d. If s/d < θ, treat this internal
     #    node as a single body, and calculate the force it exerts on body b.
-    if node.size <norm(node.position() - body.position())*theta:
+    dx = node.pos_cache[0] - body.pos_cache[0]
+    dy = node.pos_cache[1] - body.pos_cache[1]
+    dz = node.pos_cache[2] - body.pos_cache[2]
+    if node.size*node.size < (dx*dx + dy*dy + dz*dz)*theta*theta:
         return gravitational_force(node,body)
 
     # 3. Otherwise, run the procedure recursively on each child.
-    return sum(force_on(body, c, theta) for c in node.child if c is not None)
+    fx = fy = fz = 0.
+    for c in node.child:
+        if c is not None:
+            f = force_on(body, c, theta)
+            fx += f[0]
+            fy += f[1]
+            fz += f[2]
+    return np.array([fx, fy, fz])
+
+def forces_on_all(bodies, root, theta):
+    '''--------------------------------------------------------------
+    Returns an (N,3) array with the net force that the octo-tree 
+    root exerts on each one of the bodies.
+    --------------------------------------------------------------'''
+    F = np.zeros([len(bodies), 3])
+    for i in range(len(bodies)):
+        body = Node(bodies.m[i], bodies.pos[i], i)
+        body.pos_cache = bodies.pos[i]
+        F[i] = force_on(body, root, theta)
+    return F
+
+def cache_positions(root):
+    '''--------------------------------------------------------------
+    Stores in node.pos_cache the physical coordinates of every node
+    of the finished octo-tree, so force_on does not recompute them.
+    --------------------------------------------------------------'''
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        node.pos_cache = node.position()
+        if node.child is not None:
+            stack.extend(c for c in node.child if c is not None)
+
+def build_tree(bodies):
+    '''--------------------------------------------------------------
+    Builds the octo-tree with the current positions of the bodies
+    and returns its root.
+    --------------------------------------------------------------'''
+    root = None
+    for i in range(len(bodies)):
+        body = Node(bodies.m[i], bodies.pos[i], i)
+        body.reset_location()
+        root = add(body, root)
+    if root is not None:
+        cache_positions(root)
+    return root
+
+def morton_codes(pos, levels):
+    '''--------------------------------------------------------------
+    Returns the Morton (Z-order) codes of the positions, with levels
+    bits per axis. The 3 bits of each level are the label of the
+    octant (same labels as Node.place_into_octant). Bodies out of the
+    unit cube fall in the border octants, as when halving octants.
+    --------------------------------------------------------------'''
+    cells = 1 << levels
+    ijk = np.clip(np.floor(pos*cells), 0, cells-1).astype(np.int64)
+    codes = np.zeros(len(pos), np.int64)
+    for b in range(levels):
+        codes |= ((ijk[:, 0] >> b) & 1) << (3*b + 2)
+        codes |= ((ijk[:, 1] >> b) & 1) << (3*b + 1)
+        codes |= ((ijk[:, 2] >> b) & 1) << (3*b)
+    return codes
+
+def build_flat_tree(pos, m):
+    '''--------------------------------------------------------------
+    Builds the octo-tree as flat arrays, node 0 being the root:
+        child   : [K,8] children of each node (-1 if empty)
+        com     : [K,3] center of mass of each node
+        mass    : [K]   mass of each node
+        size    : [K]   side of the octant of each node
+        is_leaf : [K]   True for external nodes
+        body    : [K]   index of the body of a leaf (-1 otherwise)
+    The bodies are sorted by their Morton codes, so the bodies inside
+    any octant are a contiguous range [lo,hi) of the sorted arrays.
+    The tree is then built one level at a time.
+    --------------------------------------------------------------'''
+    smallest_octant = 1.e-4 # Lower limit for the side-size of the octants
+    # Depth of the octants that can not be subdivided anymore
+    levels = int(np.ceil(-np.log2(smallest_octant)))
+    N = len(m)
+    codes = morton_codes(pos, levels)
+    order = np.argsort(codes, kind='stable')
+    codes = codes[order]
+    m_sorted = m[order]
+    mpos_sorted = m_sorted[:, None]*pos[order]
+
+    # Octants of the current level: range of bodies and node index
+    # (-1 if the octant is not a node of the tree). Level 0 is the root.
+    run_lo, run_hi, run_id = np.array([0]), np.array([N]), np.array([0])
+    lo, hi, depth, parent, octant = [run_lo], [run_hi], [0], [-1], [0]
+    mass, mpos = [m_sorted.sum(keepdims=True)], [mpos_sorted.sum(axis=0)[None, :]]
+    n_nodes = 1
+    for d in range(1, levels+1):
+        # Only the internal nodes (more than one body) are subdivided
+        split = (run_id >= 0) & (run_hi - run_lo > 1)
+        if not split.any():
+            break
+        prefix = codes >> 3*(levels - d)
+        new_lo = np.concatenate(([0], np.flatnonzero(prefix[1:] != prefix[:-1]) + 1))
+        new_hi = np.append(new_lo[1:], N)
+        parent_run = np.searchsorted(run_lo, new_lo, side='right') - 1
+        is_node = split[parent_run]
+        k = np.count_nonzero(is_node)
+        new_id = np.full(len(new_lo), -1)
+        new_id[is_node] = np.arange(n_nodes, n_nodes + k)
+        lo.append(new_lo[is_node])
+        hi.append(new_hi[is_node])
+        depth.append(np.full(k, d))
+        parent.append(run_id[parent_run[is_node]])
+        octant.append(prefix[new_lo[is_node]] & 7)
+        # Mass and m_pos of the octants, summed over their own bodies
+        mass.append(np.add.reduceat(m_sorted, new_lo)[is_node])
+        mpos.append(np.add.reduceat(mpos_sorted, new_lo, axis=0)[is_node])
+        n_nodes += k
+        run_lo, run_hi, run_id = new_lo, new_hi, new_id
+
+    lo, hi, depth = np.concatenate(lo), np.concatenate(hi), np.hstack(depth)
+    parent, octant = np.hstack(parent), np.hstack(octant)
+    child = np.full((n_nodes, 8), -1, np.int32)
+    child[parent[1:], octant[1:]] = np.arange(1, n_nodes)
+    mass = np.concatenate(mass)
+    com = np.concatenate(mpos) / mass[:, None]
+    size = 0.5**depth
+    single = hi - lo == 1
+    is_leaf = single | (depth == levels)
+    body = np.where(is_leaf, order[lo], -1).astype(np.int32)
+    # Exact position for the leaves with a single body
+    com[single] = pos[order[lo[single]]]
+    return child, com, mass, size, is_leaf, body
+
+@njit(parallel=True, fastmath=True, cache=True)
+def forces_all(pos, m, child, com, mass, size, is_leaf, body, theta, G, cutoff2, out):
+    '''--------------------------------------------------------------
+    Barnes-Hut algorithm over the flat octo-tree. Writes into out[i]
+    the net force exerted by the tree on the body i. Each body walks
+    the tree with its own explicit stack, so bodies run in parallel.
+    No force is exerted below the squared cutoff distance cutoff2.
+    The first call compiles the kernel, which may take some tens of
+    seconds; the compiled code is cached for the next runs.
+    --------------------------------------------------------------'''
+    theta2 = theta*theta
+    for i in prange(len(m)):
+        # The tree is at most 15 levels deep (see smallest_octant), so
+        # at most 7*15+1 nodes are pending at any time.
+        stack = np.empty(128, np.int32)
+        stack[0] = 0
+        top = 1
+        # The accumulators take the floating type of G, so the caller
+        # passes float32 scalars to walk the tree in single precision
+        fx = G*0
+        fy = G*0
+        fz = G*0
+        while top > 0:
+            top -= 1
+            j = stack[top]
+            dx = com[j, 0] - pos[i, 0]
+            dy = com[j, 1] - pos[i, 1]
+            dz = com[j, 2] - pos[i, 2]
+            d2 = dx*dx + dy*dy + dz*dz
+            # 1. External node, or 2. s/d < θ: the node is a single body
+            if is_leaf[j] or size[j]*size[j] < d2*theta2:
+                # No force on itself, nor below the cutoff distance
+                if body[j] != i and d2 >= cutoff2:
+                    f = G*mass[j]*m[i]/(d2*np.sqrt(d2))
+                    fx += f*dx
+                    fy += f*dy
+                    fz += f*dz
+            # 3. Otherwise, visit each child
+            else:
+                for k in range(8):
+                    if child[j, k] >= 0:
+                        stack[top] = child[j, k]
+                        top += 1
+        out[i, 0] = fx
+        out[i, 1] = fy
+        out[i, 2] = fz
+
+def set_num_threads(threads):
+    '''--------------------------------------------------------------
+    Sets the number of threads used by Numba to compute the forces.
+    With threads = 0 all the available cores are used.
+    --------------------------------------------------------------'''
+    if NUMBA and threads > 0:
+        numba.set_num_threads(threads)
 
-def verlet(bodies, root, theta, dt):
+def compute_forces(bodies, theta, fp32=False):
     '''--------------------------------------------------------------
-    Velocity-Verlet method for time evolution.
+    Builds the octo-tree with the current positions of the bodies and
+    returns an (N,3) array with the net force on each body, using the
+    flat tree with Numba or the Node tree otherwise.
+    With fp32, the flat tree is walked in single precision; the forces
+    are returned in double precision.
     --------------------------------------------------------------'''
-    for body in bodies:
-        force = force_on(body, root, theta)
-        body.momentum += 0.5*force*dt
-        body.m_pos += body.momentum*dt
-        body.momentum += 0.5*force_on(body, root, theta)*dt
+    if NUMBA:
+        child, com, mass, size, is_leaf, body = build_flat_tree(bodies.pos, bodies.m)
+        if fp32:
+            f32 = np.float32
+            F = np.empty(bodies.pos.shape, f32)
+            forces_all(bodies.pos.astype(f32), bodies.m.astype(f32), child,
+                       com.astype(f32), mass.astype(f32), size.astype(f32),
+                       is_leaf, body, f32(theta), f32(G), f32(cutoff_dist**2), F)
+            return F.astype(np.float64)
+        F = np.empty_like(bodies.pos)
+        forces_all(bodies.pos, bodies.m, child, com, mass, size, is_leaf, body,
+                   theta, G, cutoff_dist**2, F)
+        return F
+    return forces_on_all(bodies, build_tree(bodies), theta)
+
+def verlet(bodies, F, scratch, theta, dt, fp32=False):
+    '''--------------------------------------------------------------
+    Velocity-Verlet method for time evolution (kick-drift-kick).
+    F holds the forces at the current positions. Returns the forces
+    at the new positions, to be used in the next step. scratch is an
+    (N,3) buffer reused for the updates, which are done in place.
+    --------------------------------------------------------------'''
+    np.multiply(F, 0.5*dt, out=scratch)
+    bodies.mom += scratch
+    np.multiply(bodies.mom, dt, out=scratch)
+    bodies.m_pos += scratch
+    np.divide(bodies.m_pos, bodies.m[:, None], out=bodies.pos)
+    # The octo-tree is recomputed with the new positions.
+    F = compute_forces(bodies, theta, fp32)
+    np.multiply(F, 0.5*dt, out=scratch)
+    bodies.mom += scratch
+    return F
     
-def func(x,Distribution,Point): 
-    """--------------------------------------------------------------
-    Equation that follows the point of a wanted distribution that 
-    matches the random one of a uniform distribution
-    -----------------------------------------------------------------
-       x            : Random variable in a distribution (unkonwn)
-       Distribution : Distribution's function
-       Point        : Random variable in the uniform distribution
-    --------------------------------------------------------------"""
-    return integrate.quad(Distribution,0,x)[0]-Point
-
-def Random_numbers_distribution(f, N, x0 = 0.001, normal = False, args = None):
+def Random_numbers_distribution(f, N):
     """---------------------------------------
     Creates an array of N random numbers with
-    a distribution density equal to f. 
+    a distribution density equal to f in [0,1].
+    The cumulative distribution of f is tabulated
+    once and inverted by linear interpolation.
+    f must accept NumPy arrays.
     --------------------------------------"""
-    if normal == False:
-        norm = integrate.quad(f,0,1)[0]
-        uf = lambda x: f(x)/norm #Density function with integral=1
-    Uniform = random.random(N)
-    Map = zeros(N)
-    for ii in range(N):
-        Map[ii]=fsolve(func,x0,args=(uf,Uniform[ii]))
-    return Map
+    xs = np.linspace(0, 1, 4096)
+    pdf = f(xs)
+    # Cumulative distribution (trapezoidal rule) with integral=1
+    cdf = np.zeros(len(xs))
+    cdf[1:] = np.cumsum(0.5*(pdf[1:] + pdf[:-1]))
+    cdf /= cdf[-1]
+    Uniform = np.random.random(N)
+    return np.interp(Uniform, cdf, xs)
 
 def kepler_galaxy(N, alpha = 0, beta = 0):
     '''--------------------------------------------------------------
@@ -196,36 +461,36 @@ def kepler_galaxy(N, alpha = 0, beta = 0):
     min_mass = 1    # Minimum mass 
     BHM = 4e6   # Black Hole mass
     
-    random.seed(10) # Seed
+    np.random.seed(10) # Seed
     # Generation of N random particles 
-    status = empty([N,7])
+    status = np.empty([N,7])
     # Random masses varies between min_mass and max_mass in solar masses
-    status[:-1, 0] = random.random(N-1)*(max_mass-min_mass) + min_mass
+    status[:-1, 0] = np.random.random(N-1)*(max_mass-min_mass) + min_mass
     #Random angle generation
-    gamma = random.random(N-1)*2*pi
+    gamma = np.random.random(N-1)*2*np.pi
     init_r = 0.4 # Initial radius
     center = [0.5, 0.5, 0.5] # Origin of galaxy
     #Model of density normalized
     f = lambda x: x    
     #Points mapped from the uniform distribution
     Uniform = Random_numbers_distribution(f,N-1)*init_r
-    for i in range(N-1):
-        #Change to cartesian coordinates
-        status[i, 1] = Uniform[i]*(cos(gamma[i])*cos(alpha)+ sin(gamma[i])*cos(beta)*sin(alpha)) + center[0]
-        status[i, 2] = Uniform[i]*(sin(gamma[i])*cos(beta)*cos(alpha)-cos(gamma[i])*sin(alpha)) + center[1]
-        status[i, 3] = Uniform[i]*sin(gamma[i])*sin(beta) + center[2]
-        # Keplerina velocity in the plain of the disc 
-        Kep_v = sqrt(G*BHM/Uniform[i])
-        vec_vel=array([-(sin(gamma[i])*cos(alpha)-cos(gamma[i])*cos(beta)*sin(alpha)),
-                       (cos(gamma[i])*cos(beta)*cos(alpha)+sin(gamma[i])*sin(alpha)), 
-                       cos(gamma[i])*sin(beta)])
-        status[i, 4] = status[i, 0]*Kep_v*vec_vel[0]
-        status[i, 5] = status[i, 0]*Kep_v*vec_vel[1]
-        status[i, 6] = status[i, 0]*Kep_v*vec_vel[2]
+    cg, sg = np.cos(gamma), np.sin(gamma)
+    ca, sa, cb, sb = np.cos(alpha), np.sin(alpha), np.cos(beta), np.sin(beta)
+    #Change to cartesian coordinates
+    status[:-1, 1] = Uniform*(cg*ca + sg*cb*sa) + center[0]
+    status[:-1, 2] = Uniform*(sg*cb*ca - cg*sa) + center[1]
+    status[:-1, 3] = Uniform*sg*sb + center[2]
+    # Keplerina velocity in the plain of the disc 
+    Kep_v = np.sqrt(G*BHM/Uniform)
+    vec_vel = np.empty([N-1, 3])
+    vec_vel[:, 0] = -(sg*ca - cg*cb*sa)
+    vec_vel[:, 1] = cg*cb*ca + sg*sa
+    vec_vel[:, 2] = cg*sb
+    status[:-1, 4:7] = status[:-1, 0:1]*Kep_v[:, None]*vec_vel
     # BH's information
     status[N-1, 0] = BHM
     status[N-1, 1:4]=center
-    status[N-1, 4:7]=array([0.,0.,0.])
+    status[N-1, 4:7]=0.
     return status
 
 def bessel_galaxy(N, alpha = 0, beta = 0):
@@ -237,41 +502,42 @@ def bessel_galaxy(N, alpha = 0, beta = 0):
        N            : Number of particles
     --------------------------------------------------------------'''
     from scipy.special import kv, iv
-    random.seed(10)
+    np.random.seed(10)
     init_r = 0.5  # Initial radius
     # Generates N random particles 
-    status = empty([N,7])
+    status = np.empty([N,7])
     # Random masses varies between min_mass mass and max_mass solar masses
     max_mass = 50
     min_mass = 1
-    status[:, 0] = random.random(N)*(max_mass-min_mass) + min_mass
+    status[:, 0] = np.random.random(N)*(max_mass-min_mass) + min_mass
     #Parameters of the model of density of starts (Adimentional)
     Rd = .1
     #Model of density normalized
-    f = lambda x: x*exp(-x/Rd)      
+    f = lambda x: x*np.exp(-x/Rd)      
     #Random angle generation
-    gamma = random.random(N)*2*pi
+    gamma = np.random.random(N)*2*np.pi
     #Points mapped from the uniform distribution
-    Map = Random_numbers_distribution(f,N, args=(Rd))*init_r
+    Map = Random_numbers_distribution(f,N)*init_r
     Rd *= init_r
     center = [0.5, 0.5, 0.5] # Origin of the galaxy  
-    for i in range(N):
-        #Change to cartesian coordinates
-        status[i, 1] = Map[i]*(cos(gamma[i])*cos(alpha)+ sin(gamma[i])*cos(beta)*sin(alpha)) + center[0]
-        status[i, 2] = Map[i]*(sin(gamma[i])*cos(beta)*cos(alpha)-cos(gamma[i])*sin(alpha)) + center[1]
-        status[i, 3] = Map[i]*sin(gamma[i])*sin(beta) + center[2]
-        #Velocity for particles in an exponential disc
-        y = Map[i] / (2*Rd)
-        sigma = sum(status[:,0])/(2*pi*(Rd**2-(init_r**2+init_r*Rd)*exp(-init_r/Rd)))
-        #Magnitud
-        Bessel_v = sqrt(4*pi*G*sigma*y**2*(iv(0,y)*kv(0,y)-iv(1,y)*kv(1,y)))
-        #Components 
-        vec_vel=array([-(sin(gamma[i])*cos(alpha)-cos(gamma[i])*cos(beta)*sin(alpha)),
-                       (cos(gamma[i])*cos(beta)*cos(alpha)+sin(gamma[i])*sin(alpha)), 
-                       cos(gamma[i])*sin(beta)])
-        status[i, 4] = status[i, 0]*Bessel_v*vec_vel[0]
-        status[i, 5] = status[i, 0]*Bessel_v*vec_vel[1]
-        status[i, 6] = status[i, 0]*Bessel_v*vec_vel[2]
+    cg, sg = np.cos(gamma), np.sin(gamma)
+    ca, sa, cb, sb = np.cos(alpha), np.sin(alpha), np.cos(beta), np.sin(beta)
+    #Change to cartesian coordinates
+    status[:, 1] = Map*(cg*ca + sg*cb*sa) + center[0]
+    status[:, 2] = Map*(sg*cb*ca - cg*sa) + center[1]
+    status[:, 3] = Map*sg*sb + center[2]
+    #Velocity for particles in an exponential disc
+    y = Map / (2*Rd)
+    total_mass = status[:, 0].sum()
+    sigma = total_mass/(2*np.pi*(Rd**2-(init_r**2+init_r*Rd)*np.exp(-init_r/Rd)))
+    #Magnitud
+    Bessel_v = np.sqrt(4*np.pi*G*sigma*y**2*(iv(0,y)*kv(0,y)-iv(1,y)*kv(1,y)))
+    #Components 
+    vec_vel = np.empty([N, 3])
+    vec_vel[:, 0] = -(sg*ca - cg*cb*sa)
+    vec_vel[:, 1] = cg*cb*ca + sg*sa
+    vec_vel[:, 2] = cg*sb
+    status[:, 4:7] = status[:, 0:1]*Bessel_v[:, None]*vec_vel
     return status
 
 def spiral_galaxy(N, alpha = 0, beta = 0):
@@ -282,61 +548,60 @@ def spiral_galaxy(N, alpha = 0, beta = 0):
     --------------------------------------------------------------------------
        N            : Number of particles
     ------------------------------------------------------------------------'''
-    random.seed(10)
+    np.random.seed(10)
     #Black hole's mass    
     BHM = 4e6  
     # Generates N random particles 
-    status = empty([N,7])
+    status = np.empty([N,7])
     # Random masses varies between min_mass mass and max_mass solar masses
     max_mass = 1
     min_mass = 1
-    status[:-1, 0] = random.random(N-1)*(max_mass-min_mass) + min_mass
+    status[:-1, 0] = np.random.random(N-1)*(max_mass-min_mass) + min_mass
     #Parameters of the model of density of starts
     const_bulb=2.5
     const_disc=.2
     bulb_radius=0.2
     #Model of density normalized
-    f1 = lambda x: exp(-x**(1/4)/const_bulb)        #Bulge
-    f2 = lambda x: f1(bulb_radius)*exp(-(x-bulb_radius)/const_disc) #Disc
-    f = lambda x:  x*f1(x) if x<bulb_radius else x*f2(x)                #Piecewise
+    f1 = lambda x: np.exp(-x**(1/4)/const_bulb)        #Bulge
+    f2 = lambda x: f1(bulb_radius)*np.exp(-(x-bulb_radius)/const_disc) #Disc
+    f = lambda x:  np.where(x<bulb_radius, x*f1(x), x*f2(x))               #Piecewise
     #Empty array for the points mapped from the uniform distribution
     init_r = 0.4 # Initial radius
-    Map = Random_numbers_distribution(f,N,args=(const_bulb, const_disc, bulb_radius))*init_r
+    Map = Random_numbers_distribution(f,N)*init_r
     #Random angle generation
-    gamma = random.random(N-1)*2*pi
+    gamma = np.random.random(N-1)*2*np.pi
     #Random width
     width = .02
     #Half of with in relation to the radius of the galaxy
-    gross  = random.random(N-1)*2*width-width
-    temp = beta
+    gross  = np.random.random(N-1)*2*width-width
     center = [0.5, 0.5, 0.5] # Origin of galaxy   
-    for i in range(N-1):
-        #Creates an elipsoid in the region of the bulge
-        if Map[i] < bulb_radius*init_r:
-            a = 0.072
-            bulg_countour = a*sqrt(1-(Map[i]/(bulb_radius*init_r))**2)
-            gross[i] = random.random(1)*2*bulg_countour-bulg_countour
-        #Adjustment for width
-        beta += arctan(gross[i]/Map[i])
-        Map[i] = sqrt(Map[i]**2+gross[i]**2)
-        #Change to cartesian coordinates
-        status[i, 1] = Map[i]*(cos(gamma[i])*cos(alpha)+ sin(gamma[i])*cos(beta)*sin(alpha)) + center[0]
-        status[i, 2] = Map[i]*(sin(gamma[i])*cos(beta)*cos(alpha)-cos(gamma[i])*sin(alpha)) + center[1]
-        status[i, 3] = Map[i]*sin(gamma[i])*sin(beta) + center[2]
-        # Keplerina velocity in the plain of the disc
-        #Magnitud
-        Kep_v = sqrt(G*BHM/Map[i])
-        #Components
-        vec_vel=array([-(sin(gamma[i])*cos(alpha)-cos(gamma[i])*cos(beta)*sin(alpha)),
-                       (cos(gamma[i])*cos(beta)*cos(alpha)+sin(gamma[i])*sin(alpha)), 
-                       cos(gamma[i])*sin(beta)])
-        status[i, 4] = status[i, 0]*Kep_v*vec_vel[0]
-        status[i, 5] = status[i, 0]*Kep_v*vec_vel[1]
-        status[i, 6] = status[i, 0]*Kep_v*vec_vel[2]
-        beta = temp 
+    Map = Map[:-1]
+    #Creates an elipsoid in the region of the bulge
+    a = 0.072
+    bulg_countour = a*np.sqrt(np.clip(1-(Map/(bulb_radius*init_r))**2, 0, None))
+    bulge = np.random.random(N-1)*2*bulg_countour-bulg_countour
+    gross = np.where(Map < bulb_radius*init_r, bulge, gross)
+    #Adjustment for width
+    betas = beta + np.arctan(gross/Map)
+    Map = np.sqrt(Map**2+gross**2)
+    cg, sg = np.cos(gamma), np.sin(gamma)
+    ca, sa, cb, sb = np.cos(alpha), np.sin(alpha), np.cos(betas), np.sin(betas)
+    #Change to cartesian coordinates
+    status[:-1, 1] = Map*(cg*ca + sg*cb*sa) + center[0]
+    status[:-1, 2] = Map*(sg*cb*ca - cg*sa) + center[1]
+    status[:-1, 3] = Map*sg*sb + center[2]
+    # Keplerina velocity in the plain of the disc
+    #Magnitud
+    Kep_v = np.sqrt(G*BHM/Map)
+    #Components
+    vec_vel = np.empty([N-1, 3])
+    vec_vel[:, 0] = -(sg*ca - cg*cb*sa)
+    vec_vel[:, 1] = cg*cb*ca + sg*sa
+    vec_vel[:, 2] = cg*sb
+    status[:-1, 4:7] = status[:-1, 0:1]*Kep_v[:, None]*vec_vel
     status[N-1, 0] = BHM
     status[N-1, 1:4] = center
-    status[N-1, 4:7] = array([0.,0.,0.])
+    status[N-1, 4:7] = 0.
     return status
 
 def system_init_write(N, model, ini_radius, alpha, beta, format = 'npy', data_folder = 'Data/'):
@@ -352,24 +617,28 @@ def system_init_write(N, model, ini_radius, alpha, beta, format = 'npy', data_fo
 
     Numpy_Init = open(data_folder + 'Initial State.' + format, 'wb')
     state = model(N, alpha, beta)
-    save(Numpy_Init, state)
+    np.save(Numpy_Init, state)
     Numpy_Init.close()
 
 def system_init_read(N, format = 'npy', data_folder = 'Data/'):
     '''--------------------------------------------------------------
     Reads a binary file with the initial state of the N-body system.
-    And builts the body class.
+    And builts the Bodies arrays.
     --------------------------------------------------------------'''
-    bodies = []
-    state = load(data_folder + 'Initial State.' + format)
-    for i in range(N):
-       bodies.append(Node(state[i,0], state[i, 1:4], state[i, 4:7]))
-    return bodies
+    state = np.load(data_folder + 'Initial State.' + format)[:N]
+    m = state[:, 0].copy()
+    pos = state[:, 1:4].copy()
+    return Bodies(m, pos, state[:, 4:7].copy(), m[:, None]*pos)
 
-def evolve(bodies, N, n, ini_radius, save_step, data_folder='Data/', format='npy'):
+def evolve(bodies, N, n, ini_radius, save_step, data_folder='Data/', format='npy', fp32=False, save_batch=32):
     '''--------------------------------------------------------------
     This function evolves the system in n steps of time using the 
     Verlet algorithm and the Barnes-Hut octo-tree.
+    With fp32, single precision is used only inside the walk of the
+    tree; positions and momenta are always integrated in double.
+    The saved states are gathered in batches of up to save_batch
+    states (fewer for large N, so a batch stays within 32 MB), which
+    are written by a background thread while the evolution goes on.
     --------------------------------------------------------------'''
     # Scaling of gravitational constant
     global G
@@ -377,34 +646,55 @@ def evolve(bodies, N, n, ini_radius, save_step, data_folder='Data/', format='npy
     File = open(data_folder + 'Evolution.' + format, 'wb')
     print('Evolution progress:')
     pbar = tqdm(total=n)
-    # Principal loop over n time iterations.
-    for i in range(n+1):
-        # The octo-tree is recomputed at each iteration.
-        root = None
-        for body in bodies:
-            body.reset_location()
-            root = add(body, root)
-
-        # Evolution using the Verlet method
-        verlet(bodies, root, theta, dt)
-        # Save the data in binary files
-        if i%save_step==0:
-            save_data(File, bodies, N)
-            pbar.update(save_step)
-    File.close()
+    # Forces at the initial positions.
+    F = compute_forces(bodies, theta, fp32)
+    # Buffers for the Verlet updates and for the data written to File.
+    # One batch is filled while the other one is being written.
+    batch_bytes = 2**25 # Memory limit for each batch
+    save_batch = max(1, min(save_batch, batch_bytes // (N*7*8)))
+    scratch = np.empty([N, 3])
+    batches = np.empty([2, save_batch, N, 7])
+    current, k = 0, 0
+    try:
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            pending = None
+            # Principal loop over n time iterations.
+            for i in range(n+1):
+                # Evolution using the Verlet method
+                F = verlet(bodies, F, scratch, theta, dt, fp32)
+                # Save the data in binary files
+                if i%save_step==0:
+                    copy_state(bodies, batches[current, k])
+                    k += 1
+                    if k == save_batch:
+                        # The previous batch must be written (or raise)
+                        # before its buffer is filled again
+                        if pending is not None:
+                            pending.result()
+                        pending = writer.submit(save_data, File, batches[current])
+                        current, k = 1 - current, 0
+                    pbar.update(save_step)
+            if pending is not None:
+                pending.result()
+            save_data(File, batches[current, :k])
+    finally:
+        File.close()
+
+def copy_state(bodies, Data):
+    '''--------------------------------------------------------------
+    Copies the current state of the bodies into the [N,7] array Data.
+    --------------------------------------------------------------'''
+    Data[:, 0] = bodies.m
+    Data[:, 1:4] = bodies.pos
+    Data[:, 4:] = bodies.mom
 
-def save_data(File, bodies, N):
+def save_data(File, states):
     '''--------------------------------------------------------------
-    Save data of the current state of the bodies into File.
+    Save data of the states of the bodies into File. Each state is
+    saved on its own, so they are read back one at a time.
     --------------------------------------------------------------'''
-    Data = zeros([N, 7])
-    ii = 0
-    for body in bodies:
-        Data[ii, 0] = body.m
-        Data[ii, 1:4] = body.position()
-        Data[ii, 4:] = body.momentum
-        ii +=1
-    save(File, Data)
+    for Data in states:
+        np.save(File, Data)
 
 def read_evolution(N, n, save_step, data_folder='Data/', format='npy', image_folder='imagesBH/'):
     '''--------------------------------------------------------------
@@ -415,7 +705,7 @@ def read_evolution(N, n, save_step, data_folder='Data/', format='npy', image_fol
     print('Images:')
     pbar = tqdm(total=n//save_step)
     for ii in range(n//save_step):
-        state = load(File)
+        state = np.load(File)
         plot_bodies(state[:, 0], state[:, 1:4], ii, N,image_folder)
         pbar.update(1)
 
@@ -461,15 +751,13 @@ def plot_bodies(m, pos, i, N, image_folder='imagesBH/'):
     Mmin = 1    # Minimum mass
     dot_max = 10    # Maximum markersize
     dot_min = 0.1   # Minimun markersize
-    for ii in range(N):
-        if (m[ii]> Mmax):
-            # Black hole
-            size = 2*dot_max
-            ax.scatter(pos[ii, 0], pos[ii, 1], pos[ii, 2], marker='.', s=size, color='orange')
-        else:
-            # Stars
-            size = ((dot_max-dot_min)*m[ii]+dot_min*Mmax - dot_max*Mmin)/(Mmax-Mmin)
-            ax.scatter(pos[ii, 0], pos[ii, 1], pos[ii, 2], marker='.', s=size, color='lightcyan')
+    bh = m > Mmax
+    stars = ~bh
+    # Stars
+    size = ((dot_max-dot_min)*m[stars]+dot_min*Mmax - dot_max*Mmin)/(Mmax-Mmin)
+    ax.scatter(pos[stars, 0], pos[stars, 1], pos[stars, 2], marker='.', s=size, color='lightcyan')
+    # Black holes
+    ax.scatter(pos[bh, 0], pos[bh, 1], pos[bh, 2], marker='.', s=2*dot_max, color='orange')
     plt.savefig(image_folder+'bodies_{0:06}.png'.format(i))
     plt.close()
 
@@ -499,17 +787,17 @@ def tangent_velocity_distribution(N, n, ini_radius, save_step, alpha, beta, data
     steps = n//save_step
 
     # Normal Vector
-    normal_vector = array([sqrt(1-tan(alpha)**2)*sin(beta), tan(alpha)*sin(beta), cos(beta)])
+    normal_vector = np.array([np.sqrt(1-np.tan(alpha)**2)*np.sin(beta), np.tan(alpha)*np.sin(beta), np.cos(beta)])
     print('Tangent Velocity:')
     pbar = tqdm(steps)
     # Main loop
     factor = ini_radius/0.4
-    state = load(File)
+    state = np.load(File)
     Data = tangent_velocity(state[:, 0], state[:, 1:4], state[:, 4:7], N, normal_vector)
-    Data = array(Data)*factor
-    Vmax, rmax = max(Data[1]), max(Data[0])
+    Data = np.array(Data)*factor
+    Vmax, rmax = Data[1].max(), Data[0].max()
     for ii in range(steps):
-        save(Velocity, Data, N)
+        np.save(Velocity, Data, N)
         if (ii%imag==0):
             # Image's format
             fig = plt.figure(figsize=(10,10))
@@ -523,9 +811,9 @@ def tangent_velocity_distribution(N, n, ini_radius, save_step, alpha, beta, data
             plt.savefig(image_folder+'TV_{0:06}.png'.format(ii))
             plt.close()
         pbar.update(1)      
-        state = load(File)
+        state = np.load(File)
         Data = tangent_velocity(state[:, 0], state[:, 1:4], state[:, 4:7], N, normal_vector)
-        Data = factor*array(Data)
+        Data = factor*np.array(Data)
     File.close()
     Velocity.close()
 
@@ -535,13 +823,11 @@ def tangent_velocity(m, pos, momentum, N, normal_vector):
     has normal_vector as normal vector. Returns tangent velocity and
     radius. 
     --------------------------------------------------------------'''
-    r = zeros(N)
-    vt = zeros(N)
     center = [0.5, 0.5, 0.5]
-    for i in range(N):
-        vel = momentum[i] / m[i] # Velocity
-        r[i] = norm(pos[i]-center)   # radius
-        vt[i] = dot(vel, cross(pos[i]-center, normal_vector))/ norm(pos[i]-center)
+    rvec = pos - center
+    vel = momentum / m[:, None] # Velocity
+    r = np.linalg.norm(rvec, axis=1)   # radius
+    vt = np.einsum('ij,ij->i', vel, np.cross(rvec, normal_vector)) / r
     return r, abs(vt)
 
 def read_model(model):
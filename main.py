@@ -1,6 +1,6 @@
 ''' Evolution of a N body sistem interacting gravitationally'''
 
-from common import *
+from common import system_init_read, evolve, set_num_threads
 import time
 from numpy import loadtxt
 
@@ -28,11 +28,15 @@ data_folder = Data[10]
 # Format of files
 format = Data[11]
 
+# Number of threads to compute the forces
+threads = int(Data[13])
+
 # Evolution 
+set_num_threads(threads)
 start = time.time()
 bodies = system_init_read(N, format, data_folder)
 print(f'\nSystem is compounded of {len(bodies):.0f} bodies')
-print(f'\nTotal mass of the system is: {sum(bodies[i].m for i in range(len(bodies))):.0f} Msun\n')
+print(f'\nTotal mass of the system is: {bodies.m.sum():.0f} Msun\n')
 evolve(bodies, N, n, ini_radius, save_step, data_folder, format)
 end = time.time()
 
@@ -1,8 +1,8 @@
 '''Plot of tangent velocity of bodies vs radius'''
 
-from common import *
+from common import tangent_velocity_distribution, create_video
 import time
-from numpy import loadtxt, float_
+from numpy import loadtxt
 
 
 Data = loadtxt('Parameters', dtype=str)